@@ -1,17 +1,59 @@
 from flask import Flask
 from flask_cors import CORS
 from config import SECRET_KEY, JWT_SECRET_KEY, DATABASE_URL, FRONTEND_PUBLIC_BASE_URL, BACKEND_PUBLIC_BASE_URL
+from config import DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_STATEMENT_TIMEOUT_MS
 from db import db
-from flask_jwt_extended import JWTManager
+from utils.jwt_cache import CachingJWTManager
+from utils.json_provider import ORJSONProvider
 from blockchain import Blockchain
 from flask import redirect
+from sqlalchemy import text, inspect, make_url
 import os
 
+def _upgrade_schema():
+    # create_all() does not alter existing tables; add columns/indexes introduced later
+    cols = {c["name"] for c in inspect(db.engine).get_columns("blocks")}
+    if "product_id" not in cols:
+        db.session.execute(text("ALTER TABLE blocks ADD COLUMN product_id VARCHAR(120)"))
+        db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_blocks_product_id ON blocks (product_id)"))
+    # Product.__table_args__ indexes, for products tables created before they existed
+    db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_product_custodian_created ON products (custodian, created_at)"))
+    db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_product_owner_created ON products (owner, created_at)"))
+    db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_product_status ON products (current_status)"))
+    # chains written by several workers before uq_blocks_index existed can hold duplicate
+    # heights; creating the index would fail, so report them and keep booting without it
+    dupes = db.session.execute(text(
+        'SELECT "index" FROM blocks GROUP BY "index" HAVING COUNT(*) > 1 ORDER BY "index" LIMIT 10'
+    )).scalars().all()
+    if dupes:
+        print(f"BLOCK_INDEX_DUPLICATES: heights {dupes} occur more than once; uq_blocks_index not created")
+    else:
+        db.session.execute(text('CREATE UNIQUE INDEX IF NOT EXISTS uq_blocks_index ON blocks ("index")'))
+    db.session.commit()
+
+def _engine_options(database_url):
+    # compiled-SQL cache shared by the repeated Product/History query shapes
+    options = {"query_cache_size": 1200}
+    backend = make_url(database_url).get_backend_name()
+    if backend != "sqlite":
+        # size the pool for concurrent workers; SQLite (incl. :memory:) keeps its default pool
+        options.update({
+            "pool_size": DB_POOL_SIZE,
+            "max_overflow": DB_MAX_OVERFLOW,
+            "pool_pre_ping": True,
+            "pool_recycle": 3600,
+        })
+    if backend == "postgresql":
+        options["connect_args"] = {"options": f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"}
+    return options
+
 def create_app():
     app = Flask(__name__)
+    app.json = ORJSONProvider(app)
     app.config["SECRET_KEY"] = SECRET_KEY
     app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URL
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = _engine_options(DATABASE_URL)
     app.config["JWT_SECRET_KEY"] = JWT_SECRET_KEY
     if FRONTEND_PUBLIC_BASE_URL:
         app.config["FRONTEND_PUBLIC_BASE_URL"] = FRONTEND_PUBLIC_BASE_URL.rstrip("/")
@@ -20,7 +62,7 @@ def create_app():
 
     CORS(app)
     db.init_app(app)
-    jwt = JWTManager(app)
+    jwt = CachingJWTManager(app)
 
     # Import routes inside to avoid circular imports
     from routes.auth_routes import auth_bp
@@ -35,7 +77,17 @@ def create_app():
 
     # Create DB & tables if not exist, then initialize blockchain
     with app.app_context():
+        if db.engine.dialect.name == "postgresql":
+            # required by the trigram search indexes on products; roles without CREATE
+            # privilege need a DBA to run this once, so don't block startup on it
+            try:
+                db.session.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                print(f"PG_TRGM_UNAVAILABLE: {e}")
         db.create_all()
+        _upgrade_schema()
         bc = Blockchain(app)
         app.config["BLOCKCHAIN"] = bc
 
@@ -107,19 +107,25 @@ def delete_user(username):
             deleted_products.append(pid)
 
     db.session.delete(user)
-    db.session.commit()
 
     bc = current_app.config.get("BLOCKCHAIN")
     if bc:
         actor = get_jwt().get("username")
-        block = bc.add_block({
-            "type": "delete_user",
-            "deleted_user": username,
-            "deleted_by": actor,
-            "cascade_deleted_products": deleted_products
-        })
+        try:
+            with bc.staged_block({
+                "type": "delete_user",
+                "deleted_user": username,
+                "deleted_by": actor,
+                "cascade_deleted_products": deleted_products
+            }) as block:
+                db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"BLOCKCHAIN_FAILURE: {e}")
+            return jsonify({"error": "Delete failed: could not record block"}), 500
         block_info = block.to_dict()
     else:
+        db.session.commit()
         block_info = None
 
     return jsonify({
@@ -1,9 +1,12 @@
 import hashlib
 import json
+import threading
 import time
+from contextlib import contextmanager
 from models import Block as BlockModel
 from db import db
 from sqlalchemy import asc
+from sqlalchemy.exc import IntegrityError
 
 class Block:
     def __init__(self, index, timestamp, data, previous_hash, hash_value=None):
@@ -12,6 +15,13 @@ class Block:
         self.data = data
         self.previous_hash = previous_hash
         self.hash = hash_value or self.calculate_hash()
+        self._data_json = None
+
+    def data_json(self):
+        """ The data as persist_block() stores it; computed once per block. """
+        if self._data_json is None:
+            self._data_json = json.dumps(self.data, sort_keys=True)
+        return self._data_json
 
     def calculate_hash(self):
         block_string = f"{self.index}{self.timestamp}{json.dumps(self.data, sort_keys=True)}{self.previous_hash}"
@@ -29,53 +39,175 @@ class Block:
 class Blockchain:
     def __init__(self, app=None):
         self.chain = []
+        # held from reading the parent block until the child is appended;
+        # reentrant because staged_block() syncs while holding it
+        self._write_lock = threading.RLock()
+        # chain[:_last_verified_len] has already passed is_valid_chain()
+        self._last_verified_len = 1
         if app:
             self.init_from_db()
 
     def init_from_db(self):
         rows = BlockModel.query.order_by(asc(BlockModel.index)).all()
+        backfilled = False
         if not rows or rows[0].index != 0:
             genesis = self.create_genesis_block()
-            self.chain.append(genesis)
+            self.append_block(genesis)
             self.persist_block(genesis)
         for r in rows:
-            try:
-                data_parsed = json.loads(r.data)
-            except:
-                data_parsed = r.data
-            self.chain.append(Block(r.index, r.timestamp, data_parsed, r.previous_hash, r.hash))
+            block_obj = self.block_from_row(r)
+            if r.product_id is None and isinstance(block_obj.data, dict) and block_obj.data.get("product_id"):
+                r.product_id = block_obj.data["product_id"]
+                backfilled = True
+            self.append_block(block_obj)
+        if backfilled:
+            db.session.commit()
+
+    @staticmethod
+    def block_from_row(r):
+        try:
+            data_parsed = json.loads(r.data)
+        except:
+            data_parsed = r.data
+        return Block(r.index, r.timestamp, data_parsed, r.previous_hash, r.hash)
+
+    def sync(self):
+        """ Appends blocks committed by other workers since this chain was last read. """
+        with self._write_lock:
+            rows = (BlockModel.query.filter(BlockModel.index > self.get_last_block().index)
+                    .order_by(asc(BlockModel.index)).all())
+            for r in rows:
+                self.append_block(self.block_from_row(r))
 
     def create_genesis_block(self):
         return Block(0, time.time(), {"type": "genesis"}, "0")
 
+    def append_block(self, block_obj):
+        self.chain.append(block_obj)
+
     def get_last_block(self):
         return self.chain[-1]
 
     def add_block(self, data):
-        prev = self.get_last_block()
-        new_index = prev.index + 1
-        block_obj = Block(new_index, time.time(), data, prev.hash)
-        self.chain.append(block_obj)
-        self.persist_block(block_obj)
+        with self.staged_block(data) as block_obj:
+            db.session.commit()
         return block_obj
 
-    def persist_block(self, block_obj):
+    @contextmanager
+    def staged_block(self, data):
+        """
+        Builds the next block and adds its row to the current DB session
+        without committing, so it lands in the caller's transaction:
+
+            with bc.staged_block({...}) as block:
+                db.session.commit()
+
+        The chain stays locked until the block is appended on exit, so
+        concurrent writers cannot stage two children of the same parent.
+        If the body raises, the session is rolled back and nothing is appended.
+        """
+        with self._write_lock:
+            block_obj = self._insert_next_block(data)
+            try:
+                yield block_obj
+            except Exception:
+                db.session.rollback()
+                raise
+            self.append_block(block_obj)
+
+    def _insert_next_block(self, data):
+        """
+        Inserts the next block row inside a SAVEPOINT. If another process has
+        taken that height (uq_blocks_index), only the block insert is undone;
+        the chain is re-synced and the block restaged once on the new tip.
+        """
+        for attempt in range(2):
+            self.sync()
+            prev = self.get_last_block()
+            block_obj = Block(prev.index + 1, time.time(), data, prev.hash)
+            try:
+                with db.session.begin_nested():
+                    self.persist_block(block_obj, commit=False)
+                return block_obj
+            except IntegrityError:
+                if attempt:
+                    raise
+
+    def persist_block(self, block_obj, commit=True):
         b = BlockModel(
             index=block_obj.index,
             timestamp=block_obj.timestamp,
             data=json.dumps(block_obj.data, sort_keys=True),
+            product_id=block_obj.data.get("product_id") if isinstance(block_obj.data, dict) else None,
             previous_hash=block_obj.previous_hash,
             hash=block_obj.hash,
         )
         db.session.add(b)
-        db.session.commit()
+        if commit:
+            db.session.commit()
 
     def is_valid_chain(self):
-        for i in range(1, len(self.chain)):
+        """
+        Verifies only blocks appended since the last successful check; the
+        verified prefix is linked to them through its last block's hash.
+        """
+        self.sync()
+        for i in range(self._last_verified_len, len(self.chain)):
             curr = self.chain[i]
             prev = self.chain[i - 1]
             if curr.hash != curr.calculate_hash():
                 return False, f"Hash mismatch at index {curr.index}"
             if curr.previous_hash != prev.hash:
                 return False, f"Previous hash mismatch at index {curr.index}"
-        return True, "Blockchain is valid"
\ No newline at end of file
+        self._last_verified_len = len(self.chain)
+        return True, "Blockchain is valid"
+
+    def verify_rows(self, rows):
+        """
+        Checks block rows read from the DB against the verified chain: each row
+        must hash to its stored hash and match the chain block at its index.
+        Catches rows edited after this worker loaded and verified them.
+        """
+        valid, msg = self.is_valid_chain()
+        if not valid:
+            return valid, msg
+        return self._match_rows(rows)
+
+    def verify_stored_chain(self):
+        """
+        Loads every stored block row and checks that together they are the
+        complete verified chain: heights 0..n-1, none missing or duplicated,
+        each matching the chain block at its height. Rows are read after the
+        sync, and only that snapshot is returned, so blocks other workers
+        commit meanwhile are not served unchecked.
+        Returns (valid, msg, rows).
+        """
+        with self._write_lock:
+            valid, msg = self.is_valid_chain()
+            n = len(self.chain)
+        rows = BlockModel.query.order_by(asc(BlockModel.index)).all()
+        if not valid:
+            return valid, msg, rows[:n]
+        heights = [r.index for r in rows[:n]]
+        if heights != list(range(n)):
+            gap = next((i for i, h in enumerate(heights) if h != i), len(heights))
+            return False, f"Stored chain is missing or duplicates the block at index {gap}", rows[:n]
+        if len(rows) > n and rows[n].index < n:
+            return False, f"Stored chain duplicates the block at index {rows[n].index}", rows[:n]
+        valid, msg = self._match_rows(rows[:n])
+        return valid, msg, rows[:n]
+
+    def _match_rows(self, rows):
+        # Rows are compared by value with the already-verified block at their
+        # height, so a matching row costs a few field compares rather than a
+        # json.loads + SHA-256. Only rows whose stored data text differs from the
+        # verified block's serialization are re-hashed to decide.
+        for r in rows:
+            known = self.chain[r.index] if 0 <= r.index < len(self.chain) else None
+            if r.data != (known.data_json() if known else None):
+                if self.block_from_row(r).calculate_hash() != r.hash:
+                    return False, f"Hash mismatch at index {r.index}"
+            if (known is None or known.index != r.index or known.hash != r.hash
+                    or known.previous_hash != r.previous_hash or known.timestamp != r.timestamp):
+                return False, f"Block at index {r.index} does not match the verified chain"
+        return True, "Blockchain is valid"
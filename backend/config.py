@@ -7,4 +7,7 @@ SECRET_KEY = os.getenv("SECRET_KEY", "default-dev-secret")
 JWT_SECRET_KEY = os.getenv("JWT_SECRET_KEY", "default-jwt-secret")
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///scm.db")
 FRONTEND_PUBLIC_BASE_URL = os.getenv("FRONTEND_PUBLIC_BASE_URL")
-BACKEND_PUBLIC_BASE_URL = os.getenv("BACKEND_PUBLIC_BASE_URL")
\ No newline at end of file
+BACKEND_PUBLIC_BASE_URL = os.getenv("BACKEND_PUBLIC_BASE_URL")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "5000"))
@@ -2,6 +2,12 @@ from db import db
 from datetime import datetime
 import json
 
+def _pg_trgm_installed(ddl, target, bind, **kw):
+    # trigram indexes need the pg_trgm extension; skip them where it isn't installed
+    if bind is None:
+        return True
+    return bind.execute(db.text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")).scalar() is not None
+
 class User(db.Model):
     __tablename__ = "users"
     id = db.Column(db.Integer, primary_key=True)
@@ -15,6 +21,16 @@ class User(db.Model):
 
 class Product(db.Model):
     __tablename__ = "products"
+    __table_args__ = (
+        db.Index("ix_product_custodian_created", "custodian", "created_at"),
+        db.Index("ix_product_owner_created", "owner", "created_at"),
+        db.Index("ix_product_status", "current_status"),
+        # pg_trgm GIN indexes let Postgres answer the ILIKE '%q%' search without a seq-scan
+        db.Index("ix_product_name_trgm", "name", postgresql_using="gin",
+                 postgresql_ops={"name": "gin_trgm_ops"}).ddl_if(dialect="postgresql", callable_=_pg_trgm_installed),
+        db.Index("ix_product_description_trgm", "description", postgresql_using="gin",
+                 postgresql_ops={"description": "gin_trgm_ops"}).ddl_if(dialect="postgresql", callable_=_pg_trgm_installed),
+    )
     id = db.Column(db.Integer, primary_key=True)
     product_id = db.Column(db.String(120), unique=True, nullable=False)
     name = db.Column(db.String(200), nullable=False)
@@ -55,8 +71,12 @@ class History(db.Model):
 
 class Block(db.Model):
     __tablename__ = "blocks"
+    # a second block at the same height means two writers forked the chain
+    __table_args__ = (db.Index("uq_blocks_index", "index", unique=True),)
     id = db.Column(db.Integer, primary_key=True)
     index = db.Column(db.Integer, nullable=False)
+    # denormalized from data so per-product lookups can use an index
+    product_id = db.Column(db.String(120), nullable=True, index=True)
     timestamp = db.Column(db.Float, nullable=False)
     data = db.Column(db.Text, nullable=False)
     previous_hash = db.Column(db.String(256), nullable=False)
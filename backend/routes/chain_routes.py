@@ -4,12 +4,12 @@ bp = Blueprint("chain", __name__, url_prefix="/api/chain")
 @bp.route("/", methods=["GET"])
 def get_chain():
     bc = current_app.config["BLOCKCHAIN"]
-    chain_data = [b.to_dict() for b in bc.chain]
-    valid, msg = bc.is_valid_chain()
+    valid, msg, rows = bc.verify_stored_chain()
+    chain_data = [b.to_dict() for b in rows]
     return jsonify({"chain": chain_data, "valid": valid, "message": msg})
 
 @bp.route("/validate", methods=["GET"])
 def validate_chain():
     bc = current_app.config["BLOCKCHAIN"]
-    valid, msg = bc.is_valid_chain()
+    valid, msg, _ = bc.verify_stored_chain()
     return jsonify({"valid": valid, "message": msg})
\ No newline at end of file
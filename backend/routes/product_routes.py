@@ -1,14 +1,20 @@
-from flask import Blueprint, request, jsonify, current_app, send_file, Response
+from flask import Blueprint, request, jsonify, current_app, send_file, Response, stream_with_context, g
 from flask_jwt_extended import jwt_required, get_jwt
 from db import db
-from models import Product, History, User 
+from models import Product, History, User, Block
 from utils.helpers import gen_product_id, now_ts
 from utils.roles import role_required
-import qrcode
+from schemas import create_product_schema, custody_update_schema, first_error
+from marshmallow import ValidationError
+import segno
 import io
 import base64
 import csv
-from sqlalchemy import desc, asc, or_, and_
+import threading
+from cachetools import LRUCache
+from sqlalchemy import desc, asc, or_, and_, select, text, tuple_
+from sqlalchemy.orm import raiseload
+from sqlalchemy.orm.attributes import set_committed_value
 from flask import current_app
 LOCAL_IP = "10.122.180.147"       # your IPv4 from ipconfig
 
@@ -19,6 +25,7 @@ STATUS_ORDER = [
     "Created", "ReadyForShipping", "Shipped", "InTransit", 
     "DeliveredToRetailer", "AvailableForSale", "Sold", "Recalled"
 ]
+STATUS_INDEX = {s: i for i, s in enumerate(STATUS_ORDER)}
 ROLE_ALLOWED = {
     "manufacturer": ["Created", "ReadyForShipping"],
     "distributor": ["Shipped", "InTransit", "DeliveredToRetailer"],
@@ -33,9 +40,62 @@ DISTRIBUTOR_SEQUENCE_MAP = {
     "DeliveredToRetailer": "InTransit" 
 }
 
+# QR payloads are deterministic per product, so the rendered PNG can be reused
+_QR_PNG_CACHE = LRUCache(maxsize=4096)
+_QR_PNG_LOCK = threading.Lock()
+
+def _render_qr_png(qr_data):
+    buf = io.BytesIO()
+    segno.make(qr_data, error="m").save(buf, kind="png", scale=10)
+    return buf.getvalue()
+
+def qr_png_bytes(qr_data):
+    """ Returns PNG bytes for qr_data, rendering only on a cache miss. """
+    with _QR_PNG_LOCK:
+        png = _QR_PNG_CACHE.get(qr_data)
+    if png is None:
+        png = _render_qr_png(qr_data)
+        with _QR_PNG_LOCK:
+            _QR_PNG_CACHE[qr_data] = png
+    return png
+
+TRANSFER_SQL = text("""
+    WITH upd AS (
+        UPDATE products SET custodian = :custodian, current_status = :status
+        WHERE product_id = :pid
+        RETURNING product_id
+    )
+    INSERT INTO histories (product_id, status, by_who, timestamp, latitude, longitude)
+    SELECT product_id, CAST(:status AS VARCHAR), CAST(:actor AS VARCHAR), CAST(:ts AS DOUBLE PRECISION),
+           CAST(:lat AS DOUBLE PRECISION), CAST(:lon AS DOUBLE PRECISION)
+    FROM upd
+""")
+
+def get_product_by_pid(pid):
+    """
+    Looks up a product by its public product_id. product_id is a unique column
+    rather than the primary key, so the row is selected directly instead of
+    going through session.get(); scalar_one_or_none() relies on that uniqueness.
+    """
+    return db.session.execute(select(Product).where(Product.product_id == pid)).scalar_one_or_none()
+
+def _public_base_urls():
+    """ Returns (frontend base, backend base) for public links, computed once per request. """
+    if "base_urls" in g:
+        return g.base_urls
+    base_url = current_app.config.get("FRONTEND_PUBLIC_BASE_URL")
+    if not base_url:
+        # derive from request host if not set (works on LAN too)
+        scheme = request.headers.get("X-Forwarded-Proto", request.scheme)
+        host = request.headers.get("X-Forwarded-Host", request.host)
+        base_url = f"{scheme}://{host}"
+    # Pass backend base to frontend via query param to ensure phone uses correct API host
+    backend_base = current_app.config.get("BACKEND_PUBLIC_BASE_URL") or base_url
+    g.base_urls = (base_url, backend_base)
+    return g.base_urls
+
 def status_index(s):
-    try: return STATUS_ORDER.index(s)
-    except ValueError: return None
+    return STATUS_INDEX.get(s)
 
 @bp.route("/", methods=["POST"])
 @jwt_required()
@@ -44,49 +104,44 @@ def create_product():
     """ Creates a new product, setting the creator as both owner and initial custodian. """
     claims = get_jwt()
     actor = claims.get("username")
-    data = request.json or {}
-    name = data.get("name")
-    if not name: return jsonify({"error": "Product name is required"}), 400
+    try: data = create_product_schema.load(request.json or {})
+    except ValidationError as err: return jsonify({"error": first_error(err)}), 400
+    name = data["name"]
 
     pid = gen_product_id()
     
     product = Product(
         product_id=pid, name=name, owner=actor, custodian=actor, 
-        description=data.get("description", "")
+        description=data["description"]
     )
     db.session.add(product)
 
     # Capture location if provided on create
-    lat, lon = data.get("latitude"), data.get("longitude")
+    lat, lon = data["latitude"], data["longitude"]
     hist = History(product_id=pid, status="Created", by_who=actor, timestamp=now_ts(), latitude=lat, longitude=lon)
     db.session.add(hist)
-    db.session.commit()
 
+    # Product, history and block row are committed as one transaction
     bc = current_app.config["BLOCKCHAIN"]
-    block = bc.add_block({
-        "type": "create_product", "product_id": pid, "action": "Product Created",
-        "owner": actor, "initial_custodian": actor,
-        "location": f"{lat},{lon}" if lat is not None else "N/A"
-    })
+    try:
+        with bc.staged_block({
+            "type": "create_product", "product_id": pid, "action": "Product Created",
+            "owner": actor, "initial_custodian": actor,
+            "location": f"{lat},{lon}" if lat is not None else "N/A"
+        }) as block:
+            db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"BLOCKCHAIN_FAILURE: {e}")
+        return jsonify({"error": "Create failed: could not record block"}), 500
 
     # Build absolute QR target to frontend public verify page
-    base_url = current_app.config.get("FRONTEND_PUBLIC_BASE_URL")
-    if not base_url:
-      # derive from request host if not set (works on LAN too)
-      scheme = request.headers.get('X-Forwarded-Proto', request.scheme)
-      host = request.headers.get('X-Forwarded-Host', request.host)
-      base_url = f"{scheme}://{host}"
-    # Pass backend base to frontend via query param to ensure phone uses correct API host
-    backend_base = current_app.config.get("BACKEND_PUBLIC_BASE_URL") or base_url
-    import socket
+    base_url, backend_base = _public_base_urls()
     #generate full local URL for QR code
     FRONTEND_PORT = 5173              # Vite’s default React port
     API_BASE = f"http://{LOCAL_IP}:5000"
     qr_data = f"http://{LOCAL_IP}:{FRONTEND_PORT}/verify/{pid}?api_base_url={API_BASE}"
-    img = qrcode.make(qr_data)
-    buf = io.BytesIO()
-    img.save(buf, format="PNG")
-    qr_b64 = base64.b64encode(buf.getvalue()).decode("utf-8")
+    qr_b64 = base64.b64encode(qr_png_bytes(qr_data)).decode("utf-8")
 
 
     return jsonify({
@@ -101,12 +156,21 @@ def create_product():
 @role_required(["manufacturer", "distributor", "retailer"])
 def explicit_custody_transfer():
     """ Updates status and performs custody transfer, now with strict sequence validation. """
-    claims, actor, role = get_jwt(), get_jwt().get("username"), get_jwt().get("role")
-    data = request.json or {}
-    pid, new_status, transfer_to, lat, lon = data.get("product_id"), data.get("status"), data.get("transfer_to_username"), data.get("latitude"), data.get("longitude")
-
-    if not pid or not new_status: return jsonify({"error": "product_id and status are required"}), 400
-    p = Product.query.filter_by(product_id=pid).first()
+    claims = get_jwt()
+    actor, role = claims.get("username"), claims.get("role")
+    try: data = custody_update_schema.load(request.json or {})
+    except ValidationError as err: return jsonify({"error": first_error(err)}), 400
+    pid, new_status, transfer_to, lat, lon = data["product_id"], data["status"], data["transfer_to_username"], data["latitude"], data["longitude"]
+
+    # Fetch the product and (when a handoff is requested) the recipient in one round-trip
+    recipient = None
+    if transfer_to and new_status in NEXT_ROLE_MAP:
+        row = (db.session.query(Product, User).select_from(Product)
+               .outerjoin(User, User.username == transfer_to)
+               .filter(Product.product_id == pid).first())
+        p, recipient = row if row else (None, None)
+    else:
+        p = get_product_by_pid(pid)
     if not p: return jsonify({"error": "Product not found"}), 404
 
     if p.custodian != actor and role != "super_admin": return jsonify({"error": f"Action failed: You are not the current custodian ('{p.custodian}')"}), 403
@@ -121,37 +185,52 @@ def explicit_custody_transfer():
     new_custodian = actor
     if new_status in NEXT_ROLE_MAP:
         if not transfer_to: return jsonify({"error": f"'transfer_to_username' is required for status '{new_status}'"}), 400
-        recipient = User.query.filter_by(username=transfer_to).first()
         if not recipient: return jsonify({"error": f"Recipient '{transfer_to}' not found"}), 404
         expected_role = NEXT_ROLE_MAP[new_status]
         if recipient.role != expected_role: return jsonify({"error": f"Can only transfer to '{expected_role}', but '{recipient.username}' is a '{recipient.role}'"}), 400
         new_custodian = recipient.username
     
-    p.custodian = new_custodian
-    p.current_status = new_status
-    hist = History(product_id=pid, status=new_status, by_who=actor, latitude=lat, longitude=lon)
-    db.session.add(hist)
-    db.session.commit()
-
-    block_info = None
+    if db.session.get_bind().dialect.name == "postgresql":
+        # Single statement: the history row is inserted from the UPDATE's RETURNING set
+        result = db.session.execute(TRANSFER_SQL, {
+            "pid": pid, "custodian": new_custodian, "status": new_status,
+            "actor": actor, "ts": now_ts(), "lat": lat, "lon": lon
+        })
+        # no history row means the UPDATE matched nothing: the product was deleted meanwhile
+        if result.rowcount == 0:
+            db.session.rollback()
+            return jsonify({"error": "Product not found"}), 404
+        # keep the loaded instance in sync without marking it dirty
+        set_committed_value(p, "custodian", new_custodian)
+        set_committed_value(p, "current_status", new_status)
+    else:
+        p.custodian = new_custodian
+        p.current_status = new_status
+        hist = History(product_id=pid, status=new_status, by_who=actor, latitude=lat, longitude=lon)
+        db.session.add(hist)
+
+    # The update only lands if its block can be recorded alongside it
     try:
         bc = current_app.config["BLOCKCHAIN"]
-        block = bc.add_block({
+        with bc.staged_block({
             "type": "custody_transfer" if new_status in NEXT_ROLE_MAP else "status_update", 
             "product_id": pid, "status": new_status,
             "actor": actor, "new_custodian": new_custodian, 
             "location": f"{lat},{lon}" if lat is not None else "N/A"
-        })
-        block_info = block.to_dict()
-    except Exception as e: print(f"BLOCKCHAIN_FAILURE: {e}")
+        }) as block:
+            db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"BLOCKCHAIN_FAILURE: {e}")
+        return jsonify({"error": "Update failed: could not record block"}), 500
 
-    return jsonify({"message": "Update successful", "product": p.to_dict(), "block": block_info}), 200
+    return jsonify({"message": "Update successful", "product": p.to_dict(), "block": block.to_dict()}), 200
 
 @bp.route("/<product_id>", methods=["GET"])
 @jwt_required(optional=True)
 def get_product(product_id):
     include_history = request.args.get("include_history", "false").lower() in ("1", "true", "yes")
-    p = Product.query.filter_by(product_id=product_id).first()
+    p = get_product_by_pid(product_id)
     if not p:
         return jsonify({"error": "not found"}), 404
     return jsonify(p.to_dict(include_history=include_history)), 200
@@ -167,15 +246,52 @@ def list_products():
     sort = request.args.get("sort", "created_at:desc")
 
     query = Product.query
-    claims = get_jwt()
-    if claims.get("role") != "super_admin":
-        query = query.filter(or_(Product.custodian == claims.get("username"), Product.owner == claims.get("username")))
-    
     if status: query = query.filter_by(current_status=status)
     if owner: query = query.filter_by(owner=owner)
     if from_date and to_date: query = query.filter(and_(Product.created_at >= from_date, Product.created_at <= to_date))
-    
+
+    claims = get_jwt()
+    if claims.get("role") != "super_admin":
+        # UNION of two single-column predicates instead of OR, so each side can use
+        # its (custodian|owner, created_at) index; only ids go through the UNION and
+        # its dedup, while ordering and LIMIT stay on the outer products query
+        me = claims.get("username")
+        visible_ids = select(Product.id).where(Product.custodian == me).union(
+            select(Product.id).where(Product.owner == me))
+        query = query.filter(Product.id.in_(visible_ids))
+    # to_dict() here never touches relationships; fail loudly if that changes
+    query = query.options(raiseload("*"))
+
     field, direction = sort.split(":") if ":" in sort else (sort, "asc")
+
+    cursor = request.args.get("cursor")
+    if cursor is not None:
+        # Keyset mode: page on (created_at, id) from the last seen row, fetching one
+        # extra row to detect has_next instead of running a COUNT(*)
+        if field != "created_at":
+            return jsonify({"error": "cursor pagination only supports sort=created_at"}), 400
+        # same bounds paginate() applies: at most 100 per page, never empty
+        per_page = max(1, min(per_page, 100))
+        descending = direction == "desc"
+        if cursor:
+            try:
+                ts_s, id_s = cursor.split(",")
+                last_key = (float(ts_s), int(id_s))
+            except ValueError:
+                return jsonify({"error": "invalid cursor"}), 400
+            key = tuple_(Product.created_at, Product.id)
+            query = query.filter(key < last_key if descending else key > last_key)
+        order = desc if descending else asc
+        query = query.order_by(order(Product.created_at), order(Product.id))
+        rows = query.limit(per_page + 1).all()
+        has_next = len(rows) > per_page
+        rows = rows[:per_page]
+        return jsonify({
+            "per_page": per_page, "has_next": has_next,
+            "next_cursor": f"{rows[-1].created_at!r},{rows[-1].id}" if has_next else None,
+            "products": [p.to_dict() for p in rows]
+        }), 200
+
     if hasattr(Product, field):
         col = getattr(Product, field)
         query = query.order_by(desc(col) if direction == "desc" else asc(col))
@@ -192,59 +308,83 @@ def search_products():
     q = request.args.get("query", "")
     status = request.args.get("status")
     owner = request.args.get("owner")
+    limit = max(1, min(request.args.get("limit", 100, type=int), 500))
 
-    query = Product.query.filter(or_(Product.name.ilike(f"%{q}%"), Product.description.ilike(f"%{q}%")))
+    query = Product.query
+    if q: query = query.filter(or_(Product.name.ilike(f"%{q}%"), Product.description.ilike(f"%{q}%")))
     if status: query = query.filter_by(current_status=status)
     if owner: query = query.filter_by(owner=owner)
 
-    results = query.all()
+    results = query.limit(limit).all()
     return jsonify([p.to_dict() for p in results]), 200
 
 @bp.route("/<product_id>", methods=["DELETE"])
 @jwt_required()
 @role_required(["super_admin"])
 def delete_product(product_id):
-    product = Product.query.filter_by(product_id=product_id).first()
+    product = get_product_by_pid(product_id)
     if not product: return jsonify({"error": "product not found"}), 404
     History.query.filter_by(product_id=product_id).delete()
     db.session.delete(product)
-    db.session.commit()
-    
+
     bc, block_info = current_app.config.get("BLOCKCHAIN"), None
     if bc:
-        block = bc.add_block({
-            "type": "delete_product", "product_id": product_id,
-            "deleted_by": get_jwt().get("username")
-        })
+        try:
+            with bc.staged_block({
+                "type": "delete_product", "product_id": product_id,
+                "deleted_by": get_jwt().get("username")
+            }) as block:
+                db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"BLOCKCHAIN_FAILURE: {e}")
+            return jsonify({"error": "Delete failed: could not record block"}), 500
         block_info = block.to_dict()
+    else:
+        db.session.commit()
     return jsonify({"message": "product deleted", "product_id": product_id, "block": block_info}), 200
 
 @bp.route("/<product_id>/export", methods=["GET"])
 @jwt_required()
 @role_required(["super_admin"])
 def export_history(product_id):
-    rows = History.query.filter_by(product_id=product_id).order_by(History.timestamp.asc()).all()
-    if not rows: return jsonify({"error": "no history found"}), 404
-    si = io.StringIO()
-    cw = csv.writer(si)
-    cw.writerow(["status", "by_who", "timestamp", "latitude", "longitude"])
-    for r in rows:
-        cw.writerow([r.status, r.by_who, r.timestamp, r.latitude, r.longitude])
-    output = si.getvalue()
-    return Response(output, mimetype="text/csv", headers={"Content-Disposition": f"attachment;filename={product_id}_history.csv"})
+    # yield_per as an execution option (not Result.yield_per) makes the driver use a
+    # server-side cursor, so rows are fetched in batches rather than buffered up front
+    rows = iter(db.session.execute(
+        select(History.status, History.by_who, History.timestamp, History.latitude, History.longitude)
+        .where(History.product_id == product_id).order_by(History.timestamp.asc())
+        .execution_options(yield_per=1000)
+    ))
+    first = next(rows, None)
+    if first is None: return jsonify({"error": "no history found"}), 404
+
+    def generate():
+        # csv.writer keeps quoting correct; the buffer only ever holds one line
+        si = io.StringIO()
+        cw = csv.writer(si)
+        def line(values):
+            cw.writerow(values)
+            out = si.getvalue()
+            si.seek(0)
+            si.truncate(0)
+            return out
+        yield line(["status", "by_who", "timestamp", "latitude", "longitude"])
+        yield line(first)
+        for r in rows:
+            yield line(r)
+
+    return Response(stream_with_context(generate()), mimetype="text/csv", headers={"Content-Disposition": f"attachment;filename={product_id}_history.csv"})
 
 @bp.route("/blockchain", methods=["GET"])
 @jwt_required()
 def get_blockchain():
-    bc = current_app.config["BLOCKCHAIN"]
-    chain = [b.to_dict() for b in bc.chain]
+    chain = [b.to_dict() for b in Block.query.order_by(asc(Block.index))]
     return jsonify(chain), 200
 
 @bp.route("/blockchain/<product_id>", methods=["GET"])
 @jwt_required()
 def get_product_blockchain(product_id):
-    bc = current_app.config["BLOCKCHAIN"]
-    product_blocks = [b.to_dict() for b in bc.chain if b.data.get("product_id") == product_id]
+    product_blocks = [b.to_dict() for b in Block.query.filter_by(product_id=product_id).order_by(asc(Block.index))]
     return jsonify(product_blocks), 200
 
 @bp.route("/blockchain/verify", methods=["GET"])
@@ -252,14 +392,15 @@ def get_product_blockchain(product_id):
 def verify_blockchain():
     bc = current_app.config["BLOCKCHAIN"]
     valid, msg = (False, "Validation method not found")
-    if hasattr(bc, "is_valid_chain"):
-        valid, msg = bc.is_valid_chain()
+    if hasattr(bc, "verify_stored_chain"):
+        # check the stored rows, not just this worker's in-memory copy
+        valid, msg, _ = bc.verify_stored_chain()
     return jsonify({"valid": valid, "message": msg}), 200
 
 @bp.route("/<product_id>/qrcode", methods=["GET"])
 @jwt_required(optional=True)
 def get_product_qrcode(product_id):
-    product = Product.query.filter_by(product_id=product_id).first()
+    product = get_product_by_pid(product_id)
     if not product:
         return jsonify({"error": "product not found"}), 404
     FRONTEND_PORT = 5173
@@ -267,12 +408,8 @@ def get_product_qrcode(product_id):
     base_url = f"http://{LOCAL_IP}:{FRONTEND_PORT}"
     backend_base = f"http://{LOCAL_IP}:{BACKEND_PORT}"
     qr_data = f"{base_url}/verify/{product_id}?api_base_url={backend_base}"
-    # generate PNG QR image
-    img = qrcode.make(qr_data)
-    buf = io.BytesIO()
-    img.save(buf, format="PNG")
-    buf.seek(0)
-    return send_file(buf, mimetype="image/png")
+    # generate PNG QR image (cached per payload)
+    return send_file(io.BytesIO(qr_png_bytes(qr_data)), mimetype="image/png")
 
 @bp.route("/<product_id>/history", methods=["GET"])
 @jwt_required(optional=True)
@@ -282,16 +419,14 @@ def get_product_history_from_blockchain(product_id):
     Normalizes field names so frontend always receives:
       { status, by, timestamp, latitude, longitude, raw_block_index }
     """
-    product = Product.query.filter_by(product_id=product_id).first()
+    product = get_product_by_pid(product_id)
     if not product:
         return jsonify({"error": "Product not found"}), 404
 
     bc = current_app.config["BLOCKCHAIN"]
     # get blocks related to this product
-    product_history_blocks = [
-        b.to_dict() for b in bc.chain
-        if isinstance(b.data, dict) and b.data.get("product_id") == product_id
-    ]
+    rows = Block.query.filter_by(product_id=product_id).order_by(asc(Block.index)).all()
+    product_history_blocks = [b.to_dict() for b in rows]
 
     timeline = []
     for block in product_history_blocks:
@@ -331,9 +466,10 @@ def get_product_history_from_blockchain(product_id):
             "raw_block_index": block.get("index")
         })
 
+    # verify exactly the rows the timeline was built from
     valid, msg = (False, "Validation method not found")
-    if hasattr(bc, "is_valid_chain"):
-        valid, msg = bc.is_valid_chain()
+    if hasattr(bc, "verify_rows"):
+        valid, msg = bc.verify_rows(rows)
 
     return jsonify({
         "product_details": product.to_dict(include_history=False),
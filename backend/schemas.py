@@ -0,0 +1,47 @@
+from marshmallow import Schema, fields, validate, EXCLUDE
+
+# Messages written for the frontend as complete sentences; first_error() returns these as-is
+NAME_REQUIRED = "Product name is required"
+PID_STATUS_REQUIRED = "product_id and status are required"
+_CUSTOM_MESSAGES = {NAME_REQUIRED, PID_STATUS_REQUIRED}
+
+class CreateProductSchema(Schema):
+    class Meta:
+        unknown = EXCLUDE
+
+    name = fields.String(required=True, validate=validate.Length(min=1, error=NAME_REQUIRED),
+                         error_messages={"required": NAME_REQUIRED, "null": NAME_REQUIRED})
+    description = fields.String(load_default="", allow_none=True)
+    latitude = fields.Float(load_default=None)
+    longitude = fields.Float(load_default=None)
+
+class CustodyUpdateSchema(Schema):
+    class Meta:
+        unknown = EXCLUDE
+
+    _required = {"required": PID_STATUS_REQUIRED, "null": PID_STATUS_REQUIRED}
+    product_id = fields.String(required=True, validate=validate.Length(min=1, error=_required["required"]), error_messages=_required)
+    status = fields.String(required=True, validate=validate.Length(min=1, error=_required["required"]), error_messages=_required)
+    transfer_to_username = fields.String(load_default=None)
+    latitude = fields.Float(load_default=None)
+    longitude = fields.Float(load_default=None)
+
+# Schemas are built once at import and reused for every request
+create_product_schema = CreateProductSchema()
+custody_update_schema = CustodyUpdateSchema()
+
+def first_error(err):
+    """
+    Flattens a marshmallow ValidationError to its first message, for { "error": ... } bodies.
+    Generic marshmallow messages are prefixed with their field, e.g. "latitude: Not a valid number."
+    """
+    messages, field = err.messages, None
+    while isinstance(messages, (dict, list)):
+        if isinstance(messages, dict):
+            field, messages = next(iter(messages.items()))
+        else:
+            messages = messages[0]
+    message = str(messages)
+    if message in _CUSTOM_MESSAGES or field in (None, "_schema"):
+        return message
+    return f"{field}: {message}"
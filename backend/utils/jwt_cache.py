@@ -0,0 +1,34 @@
+import hashlib
+import threading
+import time
+from cachetools import TTLCache
+from flask_jwt_extended import JWTManager
+
+class CachingJWTManager(JWTManager):
+    """
+    JWTManager that remembers decoded claims for recently seen tokens,
+    so repeat requests with the same token skip signature verification.
+    Entries live for at most `ttl` seconds and never past the token's `exp`.
+    """
+    def __init__(self, app=None, maxsize=10000, ttl=30, **kwargs):
+        self._decoded_cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._decoded_lock = threading.Lock()
+        super().__init__(app, **kwargs)
+
+    def _decode_jwt_from_config(self, encoded_token, csrf_value=None, allow_expired=False):
+        # CSRF checks and expired-token decoding stay on the uncached path
+        if csrf_value is not None or allow_expired:
+            return super()._decode_jwt_from_config(encoded_token, csrf_value, allow_expired)
+
+        key = hashlib.sha256(encoded_token.encode("utf-8")).hexdigest()
+        with self._decoded_lock:
+            claims = self._decoded_cache.get(key)
+        if claims is not None:
+            exp = claims.get("exp")
+            if exp is None or exp > time.time():
+                return dict(claims)
+
+        claims = super()._decode_jwt_from_config(encoded_token, csrf_value, allow_expired)
+        with self._decoded_lock:
+            self._decoded_cache[key] = claims
+        return dict(claims)